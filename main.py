@@ -1,15 +1,27 @@
 # main.py
 import os
+import re
 import json
 import uuid
+import shutil
+import asyncio
+import logging
 import tempfile
 import subprocess
-from typing import Optional
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import requests
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager
+from typing import List, Optional
+from fastapi import BackgroundTasks, FastAPI, HTTPException
+from pydantic import BaseModel, ValidationError
+import orjson
+import httpx
 from gtts import gTTS
+from PIL import Image, ImageDraw, ImageFont
+import mutagen
 from supabase import create_client, Client
+from postgrest.exceptions import APIError
+
+logger = logging.getLogger(__name__)
 
 # --- Config from env ---
 HUGGINGFACE_API_KEY = os.environ.get("HUGGINGFACE_API_KEY")
@@ -17,21 +29,324 @@ HUGGINGFACE_MODEL = os.environ.get("HUGGINGFACE_MODEL", "google/flan-t5-large")
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
 SUPABASE_BUCKET = os.environ.get("SUPABASE_BUCKET", "ai_videos")
+TTS_ENGINE = os.environ.get("TTS_ENGINE", "piper").lower()  # "piper" (local, offline) or "gtts" (Google, network)
+PIPER_BIN = os.environ.get("PIPER_BIN", "piper")
+PIPER_MODEL = os.environ.get("PIPER_MODEL", "en_US-amy-medium.onnx")
+HF_BATCH_WINDOW_MS = int(os.environ.get("HF_BATCH_WINDOW_MS", "50"))  # how long to wait for more prompts to batch
+HF_BATCH_MAX = int(os.environ.get("HF_BATCH_MAX", "8"))  # max prompts per HF request
+JOBS_TABLE = os.environ.get("JOBS_TABLE")  # Supabase table for job records (shared by all workers); unset = in-memory
+JOBS_MAX = max(1, int(os.environ.get("JOBS_MAX", "1024")))  # in-memory only: job records kept for /status
+HF_CACHE_SIZE = max(0, int(os.environ.get("HF_CACHE_SIZE", "512")))  # in-process LRU of model outputs; 0 disables
 FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")  # ensure ffmpeg is installed in the runtime
 
+# The clip is a static color + text frame, so x264's slower motion search buys nothing; favour speed.
+X264_ARGS = ["-preset", "ultrafast", "-tune", "stillimage", "-g", "250", "-crf", "28"]
+
+# Hardware H.264 encoders in order of preference, with their fastest settings; libx264 is the fallback
+HW_ENCODER_ARGS = {
+    "h264_nvenc": ["-preset", "p1", "-tune", "ll", "-gpu", "0", "-pix_fmt", "yuv420p"],
+    "h264_videotoolbox": ["-b:v", "1M", "-pix_fmt", "yuv420p"],
+    "h264_qsv": ["-preset", "veryfast", "-pix_fmt", "nv12"],
+}
+
+def video_codec_args(encoder: str) -> list:
+    if encoder in HW_ENCODER_ARGS:
+        return ["-c:v", encoder, *HW_ENCODER_ARGS[encoder]]
+    return ["-c:v", "libx264", *X264_ARGS, "-pix_fmt", "yuv420p"]
+
+def encoder_works(encoder: str) -> bool:
+    """
+    Run a 1-frame test encode: ffmpeg builds often list nvenc/qsv on hosts without the hardware.
+    """
+    cmd = [FFMPEG_BIN, "-hide_banner", "-v", "error", "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.04",
+           "-frames:v", "1", *video_codec_args(encoder), "-f", "null", "-"]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=20).returncode == 0
+    except Exception:
+        return False
+
+def detect_h264_encoder() -> str:
+    """
+    Pick the first hardware H.264 encoder listed by `ffmpeg -encoders` that passes a test encode, else libx264.
+    Set H264_ENCODER to force a specific (supported) encoder.
+    """
+    forced = os.environ.get("H264_ENCODER")
+    if forced:
+        if forced != "libx264" and forced not in HW_ENCODER_ARGS:
+            raise RuntimeError(f"H264_ENCODER must be libx264 or one of {', '.join(HW_ENCODER_ARGS)}, got {forced!r}")
+        return forced
+    try:
+        proc = subprocess.run([FFMPEG_BIN, "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10)
+        available = proc.stdout
+    except Exception:
+        return "libx264"
+    for name in HW_ENCODER_ARGS:
+        if f" {name} " in available and encoder_works(name):
+            return name
+    return "libx264"
+
+H264_ENCODER = detect_h264_encoder()
+
+# Bound concurrent encodes so N parallel ffmpeg jobs don't oversubscribe the CPU.
+# WEB_CONCURRENCY is uvicorn's worker count; the core budget is split across workers.
+THREADS_PER_ENCODE = int(os.environ.get("THREADS_PER_ENCODE", "2"))
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+ENCODE_SEM = asyncio.Semaphore(max(1, (os.cpu_count() or 1) // (THREADS_PER_ENCODE * WORKERS)))
+
+def is_tmpfs(path: str) -> bool:
+    """
+    True if path lives on a RAM-backed filesystem, judged by the longest matching mount in /proc/mounts.
+    """
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount = parts[1]
+                if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) > len(best):
+                    best, fstype = mount, parts[2]
+    except OSError:
+        return False
+    return fstype in ("tmpfs", "ramfs")
+
+def resolve_work_dir() -> Optional[str]:
+    """
+    Directory for per-request artifacts (audio, frame, video).
+    An explicit TMPFS_DIR is always used (with a warning if it isn't RAM-backed); otherwise
+    /dev/shm/ai_video is used when it's tmpfs, else None (system temp dir).
+    """
+    explicit = os.environ.get("TMPFS_DIR")
+    if explicit:
+        os.makedirs(explicit, exist_ok=True)
+        if not is_tmpfs(explicit):
+            logger.warning("TMPFS_DIR=%s is not on tmpfs/ramfs; per-request files will hit disk", explicit)
+        return explicit
+    if not os.path.isdir("/dev/shm"):
+        return None
+    work_dir = "/dev/shm/ai_video"
+    try:
+        os.makedirs(work_dir, exist_ok=True)
+    except OSError:
+        return None
+    return work_dir if is_tmpfs(work_dir) else None
+
+WORK_DIR = resolve_work_dir()
+
+# Background kept in memory; each request draws its title on a copy (the single frame ffmpeg loops)
+BG_IMAGE = Image.new("RGB", (1280, 720), (7, 16, 19))
+
+# Per request only a short clip of the title frame is encoded; it is then looped with stream copy to full length
+TILE_SECONDS = 1
+
+# Title is rasterized with Pillow instead of ffmpeg drawtext (no filter-string escaping, no per-encode font loading)
+TITLE_FONT_PATH = os.environ.get("TITLE_FONT_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+try:
+    TITLE_FONT = ImageFont.truetype(TITLE_FONT_PATH, 36)
+except OSError:
+    TITLE_FONT = ImageFont.load_default()
+
 if not all([HUGGINGFACE_API_KEY, SUPABASE_URL, SUPABASE_SERVICE_KEY]):
     raise RuntimeError("Set HUGGINGFACE_API_KEY, SUPABASE_URL and SUPABASE_SERVICE_KEY env variables")
 
+if WORKERS > 1 and not JOBS_TABLE:
+    # uvicorn workers share one socket, so /status polls land on arbitrary workers
+    raise RuntimeError("WEB_CONCURRENCY > 1 requires JOBS_TABLE: in-memory job records are only visible to the worker that created them")
+
+if TTS_ENGINE not in ("piper", "gtts"):
+    raise RuntimeError(f"TTS_ENGINE must be 'piper' or 'gtts', got {TTS_ENGINE!r}")
+if TTS_ENGINE == "piper":
+    # fail at startup rather than 500-ing every /generate
+    if not shutil.which(PIPER_BIN):
+        raise RuntimeError(f"piper binary {PIPER_BIN!r} not found (pip install piper-tts, or set PIPER_BIN); set TTS_ENGINE=gtts to use Google TTS instead")
+    if not os.path.isfile(PIPER_MODEL) or not os.path.isfile(PIPER_MODEL + ".json"):
+        raise RuntimeError(f"piper voice model {PIPER_MODEL!r} (and its .json config) not found; see README 'Text to speech', or set TTS_ENGINE=gtts")
+
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
-app = FastAPI(title="Free AI Video Generator (FFmpeg + gTTS + HF)")
+# Shared HuggingFace client: auth headers set once, pooled keep-alive TCP/TLS connections across requests
+hf_client = httpx.AsyncClient(
+    base_url="https://api-inference.huggingface.co",
+    headers={"Authorization": f"Bearer {HUGGINGFACE_API_KEY}", "Accept": "application/json"},
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+    timeout=120,
+)
+
+# Storage REST client used for streamed uploads (supabase-py reads the whole file into memory first)
+storage_client = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/storage/v1",
+    headers={"Authorization": f"Bearer {SUPABASE_SERVICE_KEY}", "apikey": SUPABASE_SERVICE_KEY},
+    timeout=300,
+)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the HF batcher needs the running loop; clients are closed on shutdown
+    hf_batcher.start()
+    try:
+        yield
+    finally:
+        await hf_batcher.stop()
+        await hf_client.aclose()
+        await storage_client.aclose()
+
+app = FastAPI(title="Free AI Video Generator (FFmpeg + Piper/gTTS + HF)", lifespan=lifespan)
 
 class GenerateRequest(BaseModel):
     topic: str
     role: str
     length_seconds: Optional[int] = 45  # how long approx the spoken script should be (guideline)
 
-def call_hf_generate(topic: str, role: str, length_seconds: int = 45) -> dict:
+class QuizItem(BaseModel):
+    question: str
+    options: List[str]
+    answer: str
+
+class HFOutput(BaseModel):
+    title: str
+    script: str
+    quiz: List[QuizItem]
+
+def extract_generated_text(out) -> str:
+    """
+    Pull the generated text out of one HF output item. The shape varies by model:
+    [{"generated_text": "..."}], {"generated_text": "..."}, {"text": "..."} or a bare string.
+    """
+    if isinstance(out, list) and len(out) > 0:
+        return extract_generated_text(out[0])
+    if isinstance(out, dict):
+        if "generated_text" in out:
+            return out["generated_text"]
+        if "text" in out:
+            return out["text"]
+        # fallback: stringify the element
+        return orjson.dumps(out).decode()
+    return str(out)
+
+class HFBatchRejected(Exception):
+    """
+    HF refused a list of inputs (4xx) or answered it in the wrong shape: the endpoint doesn't support batching.
+    """
+
+async def hf_request(prompts: list) -> list:
+    """
+    POST one or more prompts to the HF inference API and return one generated text per prompt.
+    A single prompt is sent as a plain string input, several as a list of inputs.
+    Raises HFBatchRejected when a multi-prompt request is rejected as such; other failures raise HTTPException.
+    """
+    url = f"/models/{HUGGINGFACE_MODEL}"
+    inputs = prompts[0] if len(prompts) == 1 else prompts
+    payload = {"inputs": inputs, "options": {"wait_for_model": True, "use_cache": True}}
+    resp = await hf_client.post(url, json=payload)
+    if not resp.is_success:
+        if len(prompts) > 1 and 400 <= resp.status_code < 500:
+            raise HFBatchRejected(f"HuggingFace rejected {len(prompts)} batched inputs: {resp.status_code} {resp.text[:300]}")
+        raise HTTPException(status_code=502, detail=f"HuggingFace error: {resp.status_code} {resp.text[:300]}")
+    out = resp.json()
+    if len(prompts) == 1:
+        return [extract_generated_text(out)]
+    if not isinstance(out, list) or len(out) != len(prompts):
+        raise HFBatchRejected(f"HuggingFace returned unexpected batch output for {len(prompts)} inputs: {str(out)[:300]}")
+    return [extract_generated_text(item) for item in out]
+
+class HFBatcher:
+    """
+    Coalesce prompts that arrive within a short window into a single HF request
+    and hand each caller back its own generated text.
+    If a batched request fails its prompts are retried one by one. Many hosted models / TGI endpoints
+    reject list inputs; when HF does (4xx or wrong output shape) batching is switched off for this process,
+    while transient failures (timeouts, 5xx) leave it on.
+    Note a list payload is its own HF cache key, so batched prompts don't hit HF's per-prompt server cache.
+    """
+    def __init__(self, window_seconds: float, max_size: int):
+        self.window_seconds = window_seconds
+        self.max_size = max(1, max_size)
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.inflight: set = set()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, prompt: str) -> str:
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((prompt, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window_seconds
+            while len(batch) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # send without blocking collection of the next batch
+            t = asyncio.create_task(self._send(batch))
+            self.inflight.add(t)
+            t.add_done_callback(self.inflight.discard)
+
+    async def _send(self, batch: list):
+        prompts = [prompt for prompt, _ in batch]
+        results = None
+        if len(prompts) > 1:
+            try:
+                results = await hf_request(prompts)
+            except HFBatchRejected as e:
+                logger.warning("HF endpoint rejected batched inputs (%s); retrying prompts individually and disabling batching", e)
+                self.max_size = 1
+            except Exception as e:
+                logger.warning("Batched HF request failed (%s); retrying prompts individually", e)
+        if results is None:
+            results = await asyncio.gather(*(self._send_one(p) for p in prompts), return_exceptions=True)
+        for (_, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, Exception):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+    async def _send_one(self, prompt: str) -> str:
+        return (await hf_request([prompt]))[0]
+
+hf_batcher = HFBatcher(HF_BATCH_WINDOW_MS / 1000, HF_BATCH_MAX)
+
+# (topic, role, length_seconds) -> parsed model output, least recently used first
+_hf_cache: "OrderedDict[tuple, HFOutput]" = OrderedDict()
+
+async def call_hf_generate(topic: str, role: str, length_seconds: int = 45) -> HFOutput:
+    """
+    Return the lesson for (topic, role, length_seconds), serving repeats from the in-process LRU cache.
+    """
+    key = (topic.strip().lower(), role.strip().lower(), length_seconds)
+    if key in _hf_cache:
+        _hf_cache.move_to_end(key)
+        return _hf_cache[key]
+    data = await _hf_generate_uncached(topic, role, length_seconds)
+    _hf_cache[key] = data
+    while len(_hf_cache) > HF_CACHE_SIZE:
+        _hf_cache.popitem(last=False)
+    return data
+
+async def _hf_generate_uncached(topic: str, role: str, length_seconds: int = 45) -> HFOutput:
     """
     Call HuggingFace inference API with a prompt that requests strict JSON:
     { "title": "...", "script": "...", "quiz": [ { "question": "...", "options": [...], "answer": "..." }, ... ] }
@@ -47,227 +362,315 @@ Example:
 {{"title":"...","script":"...","quiz":[{{"question":"...","options":["A","B","C","D"],"answer":"B" , ... ]}}
 Make sure JSON is parseable.
 """
-    headers = {"Authorization": f"Bearer {HUGGINGFACE_API_KEY}", "Accept": "application/json"}
-    url = f"https://api-inference.huggingface.co/models/{HUGGINGFACE_MODEL}"
-    payload = {"inputs": prompt, "options": {"wait_for_model": True, "use_cache": False}}
-    resp = requests.post(url, headers=headers, json=payload, timeout=120)
-    if not resp.ok:
-        raise HTTPException(status_code=502, detail=f"HuggingFace error: {resp.status_code} {resp.text[:300]}")
-    # HF sometimes returns text blobs; try to extract JSON from response
-    out = resp.json()
-    # The HF JSON response shape may vary by model; common format: [{"generated_text": "..."}]
-    text = None
-    if isinstance(out, list) and len(out) > 0:
-        if isinstance(out[0], dict):
-            # model may return {"generated_text": "..."}
-            if "generated_text" in out[0]:
-                text = out[0]["generated_text"]
-            elif "text" in out[0]:
-                text = out[0]["text"]
-            else:
-                # fallback: stringifying first element
-                text = json.dumps(out[0])
-        else:
-            text = str(out[0])
-    elif isinstance(out, dict) and "generated_text" in out:
-        text = out["generated_text"]
-    else:
-        text = str(out)
+    text = await hf_batcher.submit(prompt)
+
+    # Fast path: the model returned only the JSON object, so parse + validate in one pydantic-core pass
+    try:
+        return HFOutput.model_validate_json(text)
+    except ValidationError:
+        pass
 
     # Extract first JSON object from text
     try:
-        # Find the first '{' and parse until balancing '}' — robust extraction
+        # Decode the first JSON object starting at the first '{' (respects braces inside strings)
         start = text.find('{')
         if start == -1:
             raise ValueError("No JSON object found in model output")
-        # naive balancing
-        depth = 0
-        end = None
-        for i in range(start, len(text)):
-            if text[i] == '{':
-                depth += 1
-            elif text[i] == '}':
-                depth -= 1
-                if depth == 0:
-                    end = i
-                    break
-        if end is None:
-            raise ValueError("Could not find end of JSON in model output")
-        json_text = text[start:end+1]
-        data = json.loads(json_text)
+        data, _end = json.JSONDecoder().raw_decode(text, start)
     except Exception as e:
         # As fallback, try to parse entire text
         try:
             data = json.loads(text)
         except Exception:
             raise HTTPException(status_code=502, detail=f"Could not parse JSON from model output: {str(e)} | raw: {text[:1000]}")
-    # Validate keys
-    if "script" not in data or "title" not in data or "quiz" not in data:
-        raise HTTPException(status_code=502, detail=f"Invalid output from model: missing keys. raw: {json.dumps(data)[:800]}")
-    return data
+    # Validate schema
+    try:
+        return HFOutput.model_validate(data)
+    except ValidationError as e:
+        raise HTTPException(status_code=502, detail=f"Invalid output from model: {e.error_count()} schema errors. raw: {orjson.dumps(data).decode()[:800]}")
+
+# piper writes WAV, gTTS returns MP3
+AUDIO_EXT = "mp3" if TTS_ENGINE == "gtts" else "wav"
 
 def tts_save(script_text: str, out_path: str) -> str:
-    tts = gTTS(script_text)
-    tts.save(out_path)
+    if TTS_ENGINE == "gtts":
+        tts = gTTS(script_text)
+        tts.save(out_path)
+        return out_path
+    # local piper TTS: no network round-trip, script is fed on stdin
+    try:
+        subprocess.run([PIPER_BIN, "--model", PIPER_MODEL, "--output_file", out_path], input=script_text.encode(), check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"piper failed: {e}\n{e.stderr.decode(errors='replace')[-800:]}")
     return out_path
 
-def make_video(audio_path: str, title: str, output_path: str, duration: int = 10):
+async def run_ffmpeg(cmd: list) -> bytes:
     """
-    Create a simple MP4 using a colored background and overlay the title text.
-    duration: seconds (should be >= audio duration); we will use audio length by default.
-    Requires ffmpeg in PATH.
+    Run an ffmpeg command without blocking the event loop.
+    Raises subprocess.CalledProcessError on non-zero exit, like subprocess.run(check=True).
+    """
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    return stdout
+
+def render_title_frame(title: str, out_path: str) -> str:
+    """
+    Draw the title centered on the background image and save it as the single video frame.
+    """
+    frame = BG_IMAGE.copy()
+    draw = ImageDraw.Draw(frame)
+    left, top, right, bottom = draw.textbbox((0, 0), title, font=TITLE_FONT)
+    x = (frame.width - (right - left)) / 2 - left
+    y = (frame.height - (bottom - top)) / 2 - top
+    draw.text((x, y), title, font=TITLE_FONT, fill="white")
+    frame.save(out_path)
+    return out_path
+
+async def make_bg(title: str, tile_path: str) -> str:
+    """
+    Render background + title into one PNG frame and encode a TILE_SECONDS clip of it.
+    Independent of the audio, so it can run alongside TTS. Requires ffmpeg in PATH.
     """
-    # Create a color video of given duration, then combine with audio and overlay text using drawtext.
-    # drawtext may require a font path; fallback to default font.
-    # We'll attempt to overlay text; if drawtext fails, fallback to simple combine.
     # Use 1280x720 portrait/landscape as needed; we use 1280x720 (16:9).
-    # Determine audio duration using ffprobe
+    frame_path = tile_path + ".frame.png"
+    await asyncio.to_thread(render_title_frame, title, frame_path)
+
+    def tile_cmd(encoder: str) -> list:
+        return [
+            FFMPEG_BIN,
+            "-y",
+            "-loop", "1",
+            "-framerate", "25",
+            "-i", frame_path,
+            "-t", str(TILE_SECONDS),
+            *video_codec_args(encoder),
+            "-threads", str(THREADS_PER_ENCODE),
+            tile_path
+        ]
+    global H264_ENCODER
     try:
-        # get audio duration
-        cmd_probe = [FFMPEG_BIN.replace("ffmpeg","ffprobe"), "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", audio_path]
-        proc = subprocess.run(cmd_probe, capture_output=True, text=True)
-        audio_seconds = float(proc.stdout.strip()) if proc.stdout else duration
+        async with ENCODE_SEM:
+            try:
+                await run_ffmpeg(tile_cmd(H264_ENCODER))
+            except subprocess.CalledProcessError as e:
+                # hardware encoder stopped working after the startup test: switch to libx264 for good
+                if H264_ENCODER == "libx264":
+                    raise
+                logger.warning("%s encode failed, falling back to libx264 for this process: %s", H264_ENCODER, e.stderr.decode(errors="replace")[-300:])
+                H264_ENCODER = "libx264"
+                await run_ffmpeg(tile_cmd("libx264"))
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ffmpeg failed: {e}\n{e.stderr.decode(errors='replace')[-800:]}")
+    finally:
+        if os.path.exists(frame_path):
+            try:
+                os.remove(frame_path)
+            except: pass
+    return tile_path
+
+async def mux_av_stream(tile_path: str, audio_path: str, duration: int = 10):
+    """
+    Loop the title tile with -c:v copy (no per-second x264 work), mux the audio and yield the
+    resulting fragmented MP4 from ffmpeg's stdout in chunks, so nothing is written to disk.
+    duration: seconds (should be >= audio duration); we will use audio length by default.
+    """
+    # Determine audio duration from the file header (mutagen handles both piper WAV and gTTS MP3; no ffprobe subprocess)
+    try:
+        audio_seconds = mutagen.File(audio_path).info.length
     except Exception:
         audio_seconds = duration
 
     # choose final duration slightly above audio_seconds
     final_dur = max(int(audio_seconds + 0.5), duration)
 
-    tmp_color = output_path + ".color.mp4"
-    # create a color video
-    cmd = [
+    # stdout isn't seekable, so +faststart is replaced by a fragmented mp4 (moov up front, playable while streaming)
+    cmd_mux = [
         FFMPEG_BIN,
         "-y",
-        "-f", "lavfi",
-        "-i", f"color=c=0x071013:s=1280x720:d={final_dur}",
-        "-vf", f"drawtext=fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf:text='{title}':fontsize=36:fontcolor=white:x=(w-text_w)/2:y=(h-text_h)/2",
-        "-c:v", "libx264",
+        "-stream_loop", "-1",
+        "-i", tile_path,
+        "-i", audio_path,
+        "-map", "0:v",
+        "-map", "1:a",
+        "-c:v", "copy",
+        "-c:a", "aac",
+        "-b:a", "96k",
+        "-ac", "1",
         "-t", str(final_dur),
-        "-pix_fmt", "yuv420p",
-        tmp_color
+        "-shortest",
+        "-movflags", "frag_keyframe+empty_moov",
+        "-f", "mp4",
+        "pipe:1"
     ]
+    proc = await asyncio.create_subprocess_exec(*cmd_mux, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    # drain stderr alongside stdout so ffmpeg never blocks on a full pipe
+    stderr_task = asyncio.create_task(proc.stderr.read())
     try:
-        subprocess.run(cmd, check=True, capture_output=True)
-        # combine with audio
-        cmd2 = [
-            FFMPEG_BIN,
-            "-y",
-            "-i", tmp_color,
-            "-i", audio_path,
-            "-c:v", "libx264",
-            "-c:a", "aac",
-            "-shortest",
-            output_path
-        ]
-        subprocess.run(cmd2, check=True, capture_output=True)
-    except subprocess.CalledProcessError as e:
-        # If drawtext/font problems, fallback to simple combine without text overlay
-        try:
-            cmd_fallback = [
-                FFMPEG_BIN,
-                "-y",
-                "-f", "lavfi",
-                "-i", f"color=c=0x071013:s=1280x720:d={final_dur}",
-                "-i", audio_path,
-                "-c:v", "libx264",
-                "-c:a", "aac",
-                "-shortest",
-                output_path
-            ]
-            subprocess.run(cmd_fallback, check=True, capture_output=True)
-        except Exception as e2:
-            raise RuntimeError(f"ffmpeg failed: {e}\nfallback failed: {e2}")
+        while chunk := await proc.stdout.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+        await proc.wait()
+        stderr = await stderr_task
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {proc.returncode}\n{stderr.decode(errors='replace')[-800:]}")
     finally:
-        # cleanup temp
-        if os.path.exists(tmp_color):
-            try:
-                os.remove(tmp_color)
-            except: pass
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr_task.cancel()
 
-def upload_to_supabase_and_insert(title: str, role: str, file_path: str, quiz: list):
+async def upload_to_supabase_and_insert(title: str, role: str, content, quiz: List[QuizItem]):
+    """
+    content: async iterator of video bytes (e.g. mux_av_stream), streamed as the request body.
+    """
     # create a unique filename
-    filename = f"{role.lower()}_{uuid.uuid4().hex}.mp4"
-    # upload to bucket
-    with open(file_path, "rb") as f:
-        res = supabase.storage.from_(SUPABASE_BUCKET).upload(filename, f, {"contentType": "video/mp4"})
-    if res.get("error"):
-        raise RuntimeError(f"Supabase upload error: {res['error']}")
+    # role is user input and ends up in the Storage URL path: keep only [a-z0-9_-]
+    safe_role = re.sub(r"[^a-z0-9_-]+", "_", role.lower()).strip("_") or "video"
+    filename = f"{safe_role}_{uuid.uuid4().hex}.mp4"
+    # stream to the bucket in chunks (chunked transfer, only one chunk in memory)
+    res = await storage_client.post(
+        f"/object/{SUPABASE_BUCKET}/{filename}",
+        content=content,
+        headers={"Content-Type": "video/mp4"},
+    )
+    if not res.is_success:
+        raise RuntimeError(f"Supabase upload error: {res.status_code} {res.text[:300]}")
+    # URL lookup and DB insert still go through the sync supabase client
+    return await asyncio.to_thread(insert_video_row, title, role, filename, quiz)
+
+def insert_video_row(title: str, role: str, filename: str, quiz: List[QuizItem]):
     # get public url (public bucket) or create signed URL (private)
-    # Try public first:
+    # supabase-py 2.x: get_public_url builds the URL string locally, create_signed_url returns {"signedURL", "signedUrl"}
+    bucket = supabase.storage.from_(SUPABASE_BUCKET)
     try:
-        pub = supabase.storage.from_(SUPABASE_BUCKET).get_public_url(filename)
-        video_url = pub.get("publicURL") or pub.get("data", {}).get("publicUrl") or pub.get("data", {}).get("publicURL")
-        if not video_url:
-            # try create signed url for 24h
-            signed = supabase.storage.from_(SUPABASE_BUCKET).create_signed_url(filename, 60*60*24)
-            video_url = signed.get("signedURL") or signed.get("data", {}).get("signedUrl")
+        video_url = bucket.get_public_url(filename)
     except Exception:
-        # fallback
-        signed = supabase.storage.from_(SUPABASE_BUCKET).create_signed_url(filename, 60*60*24)
-        video_url = signed.get("signedURL") or signed.get("data", {}).get("signedUrl")
+        video_url = None
+    if not video_url:
+        # fallback: signed url for 24h
+        signed = bucket.create_signed_url(filename, 60*60*24)
+        video_url = signed.get("signedURL") or signed.get("signedUrl")
 
     # Insert metadata into videos table
     # Use quiz[0] as primary question for legacy schema; also store JSON options as array
     primary_q = quiz[0] if quiz and len(quiz) > 0 else None
-    quiz_question = primary_q.get("question") if primary_q else None
-    quiz_options = primary_q.get("options") if primary_q else None
-    quiz_answer = primary_q.get("answer") if primary_q else None
+    quiz_question = primary_q.question if primary_q else None
+    quiz_options = primary_q.options if primary_q else None
+    quiz_answer = primary_q.answer if primary_q else None
 
     insert_payload = {
         "title": title,
         "video_url": video_url,
         "role": role,
         "quiz_question": quiz_question,
-        "quiz_options": json.dumps(quiz_options) if quiz_options else None,
+        "quiz_options": orjson.dumps(quiz_options).decode() if quiz_options else None,
         "quiz_answer": quiz_answer
     }
     # Attempt insert
-    resp = supabase.table("videos").insert(insert_payload).execute()
-    if resp.get("error"):
+    try:
+        resp = supabase.table("videos").insert(insert_payload).execute()
+    except APIError as e:
         # still return video_url but error on DB insert
-        return {"video_url": video_url, "insert_error": resp["error"]}
-    return {"video_url": video_url, "db_result": resp.get("data")}
+        return {"video_url": video_url, "insert_error": e.message or str(e)}
+    return {"video_url": video_url, "db_result": resp.data}
+
+# In-memory fallback when JOBS_TABLE is unset (single worker only):
+# job_id -> {"status": "processing" | "done" | "failed", ...}, oldest first
+JOBS: "OrderedDict[str, dict]" = OrderedDict()
 
-@app.post("/generate")
-def generate(req: GenerateRequest):
+async def save_job(job_id: str, record: dict):
+    """
+    Create or update a job record: a JOBS_TABLE row (id, status, title, video_url, error, meta) or the in-memory map.
+    """
+    if JOBS_TABLE:
+        row = {"id": job_id, **record}
+        # postgrest APIError propagates to the caller
+        await asyncio.to_thread(lambda: supabase.table(JOBS_TABLE).upsert(row).execute())
+        return
+    JOBS[job_id] = record
+    while len(JOBS) > JOBS_MAX:
+        JOBS.popitem(last=False)
+
+async def load_job(job_id: str) -> Optional[dict]:
+    if JOBS_TABLE:
+        resp = await asyncio.to_thread(lambda: supabase.table(JOBS_TABLE).select("*").eq("id", job_id).limit(1).execute())
+        rows = resp.data or []
+        if not rows:
+            return None
+        return {k: v for k, v in rows[0].items() if k != "id" and v is not None}
+    return JOBS.get(job_id)
+
+async def publish_video(job_id: str, tmpdir: str, tile_path: str, audio_path: str, title: str, role: str, quiz: List[QuizItem], duration: int):
+    """
+    Background half of /generate: mux tile + audio, pipe ffmpeg's output straight into the upload,
+    insert the DB row and record the outcome with save_job.
+    """
+    try:
+        # aclosing: kill ffmpeg right away if the upload bails out mid-stream
+        async with aclosing(mux_av_stream(tile_path, audio_path, duration=duration)) as video_stream:
+            up_res = await upload_to_supabase_and_insert(title, role, video_stream, quiz)
+    except Exception as e:
+        record = {"status": "failed", "title": title, "error": f"Video creation/upload failed: {str(e)}"}
+    else:
+        record = {"status": "done", "title": title, "video_url": up_res.get("video_url"), "meta": up_res.get("db_result") or up_res.get("insert_error")}
+    finally:
+        # clean temp files (best effort), also on failure since the work dir may be RAM-backed
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    try:
+        await save_job(job_id, record)
+    except Exception:
+        logger.exception("Could not record outcome of job %s", job_id)
+
+@app.post("/generate", status_code=202)
+async def generate(req: GenerateRequest, bg: BackgroundTasks):
     # 1) generate script + quiz via HF
     try:
-        hf_out = call_hf_generate(req.topic, req.role, req.length_seconds)
+        hf_out = await call_hf_generate(req.topic, req.role, req.length_seconds)
     except HTTPException as he:
         raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM generation failed: {str(e)}")
 
-    title = hf_out.get("title", f"{req.topic} for {req.role}")
-    script = hf_out["script"]
-    quiz = hf_out["quiz"]
+    title = hf_out.title or f"{req.topic} for {req.role}"
+    script = hf_out.script
+    quiz = hf_out.quiz
 
-    # 2) TTS
-    tmpdir = tempfile.mkdtemp(prefix="ai_video_")
-    audio_path = os.path.join(tmpdir, "audio.mp3")
+    # 2) TTS and title tile don't depend on each other; run them concurrently
+    tmpdir = tempfile.mkdtemp(prefix="ai_video_", dir=WORK_DIR)
     try:
-        tts_save(script, audio_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"TTS failed: {str(e)}")
+        audio_path = os.path.join(tmpdir, f"audio.{AUDIO_EXT}")
+        tile_path = os.path.join(tmpdir, "tile.mp4")
+        tts_res, bg_res = await asyncio.gather(
+            asyncio.to_thread(tts_save, script, audio_path),
+            make_bg(title, tile_path),
+            return_exceptions=True,
+        )
+        if isinstance(tts_res, Exception):
+            raise HTTPException(status_code=500, detail=f"TTS failed: {str(tts_res)}")
+        if isinstance(bg_res, Exception):
+            raise HTTPException(status_code=500, detail=f"Video creation failed: {str(bg_res)}")
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
 
-    # 3) Make video
-    video_out = os.path.join(tmpdir, "video.mp4")
+    # 3) Mux + upload + DB insert run after the response; the client polls /status/{job_id} for video_url
+    job_id = uuid.uuid4().hex
     try:
-        make_video(audio_path, title, video_out, duration=req.length_seconds)
+        await save_job(job_id, {"status": "processing", "title": title})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Video creation failed: {str(e)}")
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise HTTPException(status_code=500, detail=f"Job record failed: {str(e)}")
+    bg.add_task(publish_video, job_id, tmpdir, tile_path, audio_path, title, req.role, quiz, req.length_seconds)
 
-    # 4) Upload and insert
-    try:
-        up_res = upload_to_supabase_and_insert(title, req.role, video_out, quiz)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Upload/DB insert failed: {str(e)}")
+    return {"ok": True, "status": "processing", "job_id": job_id, "title": title, "quiz": quiz}
 
-    # clean temp files (best effort)
+@app.get("/status/{job_id}")
+async def status(job_id: str):
     try:
-        for f in [audio_path, video_out]:
-            if os.path.exists(f):
-                os.remove(f)
-    except: pass
-
-    return {"ok": True, "title": title, "video_url": up_res.get("video_url"), "quiz": quiz, "meta": up_res.get("db_result") or up_res.get("insert_error")}
+        job = await load_job(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Job lookup failed: {str(e)}")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return {"job_id": job_id, **job}